@@ -1,124 +1,263 @@
 import zipfile
 import os
+import posixpath
 import re
 import hashlib
+import struct
 import argparse
 from pathlib import Path
-from bs4 import BeautifulSoup
-import tempfile
-from collections import defaultdict
-
-def detect_epub_type(temp_path: Path) -> str:
+from urllib.parse import unquote
+from lxml import etree
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import islice
+
+try:
+    import xxhash
+except ImportError: # Optional, fall back to hashlib's SHA256
+    xxhash = None
+
+try:
+    from zlib_ng import zlib_ng as zlib
+    # Optional drop-in for zipfile's zlib, with SIMD deflate and CRC32 for the repack
+    zipfile.zlib = zlib
+    zipfile.crc32 = zlib.crc32
+except ImportError: # Keep the stdlib zlib
+    import zlib
+
+# Recover from malformed markup where libxml2 can. Files it can't parse at all (see parse_xml) are left untouched.
+XML_PARSER = etree.XMLParser(recover=True)
+# Every text node under the article's <p> tags, collected in C by libxml2.
+PARAGRAPH_TEXT = etree.XPath(".//*[local-name()='p']//text()", smart_strings=False)
+# The article marker for each ePub type, compiled once per process and matched in C.
+ARTICLE_SELECTORS = {
+    'calibre': etree.XPath("//*[local-name()='div' and @class='toc']"),
+    'raw': etree.XPath("//*[local-name()='div' and @class='art-cnt']"),
+}
+# OPF manifest items pointing at .xhtml files, spine entries, and NCX navigation points.
+MANIFEST_XHTML_ITEMS = etree.XPath(
+    "//*[local-name()='manifest']//*[local-name()='item'][substring(@href, string-length(@href) - 5) = '.xhtml']"
+)
+SPINE_ITEMREFS = etree.XPath("//*[local-name()='spine']//*[local-name()='itemref']")
+NAV_POINTS = etree.XPath("//*[local-name()='navMap']//*[local-name()='navPoint']")
+NAV_POINT_SRC = etree.XPath("string((.//*[local-name()='content'])[1]/@src)", smart_strings=False)
+PAGE_NUM_RE = re.compile(r'page-(\d+)')
+
+def detect_epub_type(zip_ref: zipfile.ZipFile) -> str:
     """Detects if the ePub is a supported PressReader file and determines its type.
     Returns 'calibre', 'raw', or 'unsupported'."""
     # Search for a unique PressReader footprint in any XHTML file.
     # This confirms it's a PressReader ePub.
     is_pressreader = False
-    all_xhtml_files = list(temp_path.glob("**/*.xhtml"))
+    names = zip_ref.namelist()
 
     # Check a few files to avoid scanning the whole book if unnecessary
-    for xhtml_file in all_xhtml_files[:5]:
-        with open(xhtml_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-            if "PressReader.com" in content or "NewspaperDirect" in content:
-                is_pressreader = True
-                break
+    for xhtml_file in islice((name for name in names if name.endswith('.xhtml')), 5):
+        content = zip_ref.read(xhtml_file).decode('utf-8')
+        if "PressReader.com" in content or "NewspaperDirect" in content:
+            is_pressreader = True
+            break
 
     if not is_pressreader:
         return 'unsupported'
 
     # Now that we know it's a PressReader file, check if it was converted by Calibre.
-    opf_file = next(temp_path.glob("**/content.opf"), None)
+    opf_file = next((name for name in names if name == 'content.opf' or name.endswith('/content.opf')), None)
     if opf_file:
-        with open(opf_file, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = zip_ref.read(opf_file).decode('utf-8')
         if 'calibre' in content:
             print("Detection: Calibre-converted PressReader ePub found.")
             return 'calibre'
     print("Detection: Raw PressReader ePub found.")
     return 'raw'
 
-def get_article_hash(article_tag):
-    """Generates a SHA256 hash from the body text (<p> tags) of an article."""
-    paragraphs = article_tag.find_all('p')
-    body_text = "".join(p.get_text(strip=True) for p in paragraphs)
-    return hashlib.sha256(body_text.encode('utf-8')).hexdigest()
+def find_oebps_prefix(names: list[str]) -> str:
+    """Returns the archive path of the first OEBPS folder (with a trailing slash), or '' if there is none."""
+    for name in names:
+        parts = name.split('/')
+        if 'OEBPS' in parts[:-1]:
+            return '/'.join(parts[:parts.index('OEBPS') + 1]) + '/'
+    return ''
+
+def parse_xml(data: bytes):
+    """Parses an XML file leniently, returning its root element or None if nothing usable could be parsed
+    (e.g. an empty or non-XML file), so callers can skip it instead of failing the whole run."""
+    try:
+        return etree.fromstring(data, XML_PARSER)
+    except etree.XMLSyntaxError:
+        return None
 
-def get_page_num_from_path(path: Path):
-    """Extracts the page number from a file path using regex."""
-    match = re.search(r'page-(\d+)', str(path))
+def find_articles(tree, epub_type: str) -> list:
+    """Returns the article elements of a page, in document order, using the marker for the ePub type."""
+    return ARTICLE_SELECTORS[epub_type](tree)
+
+def remove_element(element):
+    """Removes an element from its tree, keeping its tail text in place."""
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+    parent.remove(element)
+
+def get_article_text(article_element) -> bytes:
+    """Extracts the body text (<p> tags) of an article, which is what duplicates are compared on."""
+    return "".join(text.strip() for text in PARAGRAPH_TEXT(article_element)).encode('utf-8')
+
+def get_article_hash(body_text: bytes, cryptographic: bool = False):
+    """Generates a hash from the body text of an article.
+    Uses xxh3_128 when xxhash is installed, as duplicates only need an equality check,
+    and SHA256 otherwise or when cryptographic is set."""
+    if xxhash and not cryptographic:
+        return xxhash.xxh3_128_hexdigest(body_text)
+    return hashlib.sha256(body_text).hexdigest()
+
+@lru_cache(maxsize=None)
+def get_page_num_from_path(path: str):
+    """Extracts the page number from a file path using regex. Cached, as Stage 2 asks for the same paths repeatedly."""
+    match = PAGE_NUM_RE.search(path)
     return int(match.group(1)) if match else None
 
-def find_correct_version(path_list: list[Path]) -> Path:
-    """Finds the correct version of an article to keep from a list of paths.
+def find_correct_version(path_list: list[str]) -> str:
+    """Finds the correct version of an article to keep from a list of paths already in page order.
     Rule: Keep the first page of the last consecutive block of pages."""
     if not path_list:
         return None
 
-    pages = sorted([(get_page_num_from_path(p), p) for p in path_list if get_page_num_from_path(p) is not None])
+    paths = [p for p in path_list if get_page_num_from_path(p) is not None]
 
-    if not pages:
+    if not paths:
         return path_list[0] # Fallback if no page numbers found
 
-    correct_page_num, correct_path = pages[-1]
-
-    for i in range(len(pages) - 2, -1, -1):
-        page_num, path = pages[i]
-        if page_num == correct_page_num - 1:
-            correct_page_num, correct_path = page_num, path
-        else:
-            break
-
-    return correct_path
-
-def update_metadata_files(temp_path: Path, deleted_files: set, epub_type: str):
-    """Parses OPF and NCX files to remove all references to deleted XHTML files."""
-    # Determine correct base paths based on ePub type
-    if epub_type == 'raw':
-        # In raw files, opf and ncx are inside OEBPS
-        metadata_base_path = next(temp_path.glob("**/OEBPS"), temp_path)
-    else: # calibre
-        # In Calibre files, they are in the root
-        metadata_base_path = temp_path
-
-    deleted_rel_paths = {f.relative_to(metadata_base_path).as_posix() for f in deleted_files}
+    i = len(paths) - 1
+    while i > 0 and get_page_num_from_path(paths[i - 1]) == get_page_num_from_path(paths[i]) - 1:
+        i -= 1
+
+    return paths[i]
+
+def _scan_file(data: bytes, epub_type: str, cryptographic_hash: bool = False) -> tuple[list[tuple[int, str]], bool]:
+    """Stage 1 worker: returns (text length, hash) for every article in a page file, in document order,
+    and whether the file has a <body> (files without one are never modified)."""
+    root = parse_xml(data)
+    if root is None:
+        return [], False
+    fingerprints = []
+    for article in find_articles(root, epub_type):
+        body_text = get_article_text(article)
+        fingerprints.append((len(body_text), get_article_hash(body_text, cryptographic_hash)))
+    return fingerprints, root.find('.//{*}body') is not None
+
+def _clean_file(data: bytes, keep_flags: list[bool], epub_type: str) -> bytes:
+    """Stage 3 worker: removes the articles not flagged to keep and returns the new file contents."""
+    root = parse_xml(data)
+    if root is None:
+        return data
+    for article, keep in zip(find_articles(root, epub_type), keep_flags):
+        if not keep:
+            remove_element(article)
+
+    return etree.tostring(root.getroottree(), encoding='utf-8', xml_declaration=True)
+
+def new_entry_info(source_info: zipfile.ZipInfo) -> zipfile.ZipInfo:
+    """Creates a fresh ZipInfo carrying over the name, timestamp and attributes of a source entry."""
+    zinfo = zipfile.ZipInfo(source_info.filename, source_info.date_time)
+    zinfo.create_system = source_info.create_system
+    zinfo.external_attr = source_info.external_attr
+    return zinfo
+
+def compress_entry(source_info: zipfile.ZipInfo, data: bytes, compress_level: int):
+    """Stage 5 worker: deflates a modified file ahead of writing, returning (zipinfo, payload).
+    zlib releases the GIL, so these run in parallel on a thread pool."""
+    zinfo = new_entry_info(source_info)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.file_size = len(data)
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    zinfo.compress_size = len(payload)
+    return zinfo, payload
+
+def copy_entry(zip_ref: zipfile.ZipFile, source_info: zipfile.ZipInfo):
+    """Reads an untouched entry's data exactly as stored in the source archive, returning (zipinfo, payload).
+    Skips both inflating it here and deflating it again in the output, which also means its CRC is
+    carried over as-is rather than verified. Not for encrypted entries, whose flag isn't carried over."""
+    zip_ref.fp.seek(source_info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, zip_ref.fp.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad magic number for file header of '{source_info.filename}'")
+    name_length, extra_length = header[10], header[11]
+    zip_ref.fp.seek(name_length + extra_length, os.SEEK_CUR)
+    payload = zip_ref.fp.read(source_info.compress_size)
+
+    zinfo = new_entry_info(source_info)
+    zinfo.compress_type = source_info.compress_type
+    zinfo.CRC = source_info.CRC
+    zinfo.file_size = source_info.file_size
+    zinfo.compress_size = source_info.compress_size
+    return zinfo, payload
+
+def write_compressed_entry(zipf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, payload: bytes):
+    """Appends an entry whose payload is already compressed, with CRC and sizes set on zinfo.
+    zipfile has no public API for this, so the local header is written the same way ZipFile.open('w') does."""
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader())
+    zipf.fp.write(payload)
+    zipf.start_dir = zipf.fp.tell()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+
+def normalize_href(href: str) -> str:
+    """Normalizes an OPF/NCX reference for comparison with archive paths: drops the fragment,
+    URL-decodes it and resolves './' and trailing slashes."""
+    return posixpath.normpath(unquote(href.split('#')[0]))
+
+def find_metadata_files(names: list[str], metadata_base_path: str) -> list[str]:
+    """Returns the archive paths of the OPF and NCX files directly inside metadata_base_path, when present."""
+    metadata_files = [name for name in names if name.startswith(metadata_base_path) and '/' not in name[len(metadata_base_path):]]
+    found = (next((name for name in metadata_files if name.endswith(ext)), None) for ext in ('.opf', '.ncx'))
+    return [name for name in found if name]
+
+def update_metadata_files(metadata_contents: dict[str, bytes], deleted_rel_paths: set[str]) -> dict[str, bytes]:
+    """Parses the OPF and NCX files (given as archive path -> contents) to remove all references to
+    deleted XHTML files, given as paths relative to the metadata folder.
+    Returns the new contents of the metadata files that were rewritten, keyed by archive path."""
+    updated_files = {}
 
     # Update content.opf
-    opf_file = next(metadata_base_path.glob("*.opf"), None)
-    if opf_file:
+    opf_file = next((name for name in metadata_contents if name.endswith('.opf')), None)
+    root = parse_xml(metadata_contents[opf_file]) if opf_file else None
+    if root is not None:
         print("Updating content.opf manifest...")
-        with open(opf_file, 'r+', encoding='utf-8') as f:
-            soup = BeautifulSoup(f, 'xml')
-            ids_to_delete = set()
+        items_to_delete = [item for item in MANIFEST_XHTML_ITEMS(root) if normalize_href(item.get('href')) in deleted_rel_paths]
+        ids_to_delete = {item.get('id') for item in items_to_delete}
 
-            for item in soup.select('manifest item[href$=".xhtml"]'):
-                if item.get('href') in deleted_rel_paths:
-                    ids_to_delete.add(item.get('id'))
-                    item.decompose()
+        for item in items_to_delete:
+            remove_element(item)
 
-            for itemref in soup.select('spine itemref'):
-                if itemref.get('idref') in ids_to_delete:
-                    itemref.decompose()
+        for itemref in SPINE_ITEMREFS(root):
+            if itemref.get('idref') in ids_to_delete:
+                remove_element(itemref)
 
-            f.seek(0); f.write(str(soup)); f.truncate()
+        updated_files[opf_file] = etree.tostring(root.getroottree(), encoding='utf-8', xml_declaration=True)
 
     # Update toc.ncx
-    ncx_file = next(metadata_base_path.glob("*.ncx"), None)
-    if ncx_file:
+    ncx_file = next((name for name in metadata_contents if name.endswith('.ncx')), None)
+    root = parse_xml(metadata_contents[ncx_file]) if ncx_file else None
+    if root is not None:
         print("Updating toc.ncx navigation...")
-        with open(ncx_file, 'r+', encoding='utf-8') as f:
-            soup = BeautifulSoup(f, 'xml')
 
-            for navpoint in soup.select('navMap navPoint'):
-                content_tag = navpoint.select_one('content')
-                if content_tag and content_tag.get('src'):
-                    src_path = content_tag['src'].split('#')[0]
-                    if src_path in deleted_rel_paths:
-                        navpoint.decompose()
+        for navpoint in NAV_POINTS(root):
+            if normalize_href(NAV_POINT_SRC(navpoint)) in deleted_rel_paths:
+                remove_element(navpoint)
+
+        updated_files[ncx_file] = etree.tostring(root.getroottree(), encoding='utf-8', xml_declaration=True)
 
-            f.seek(0); f.write(str(soup)); f.truncate()
+    return updated_files
 
-def clean_epub(epub_path: Path, keep_first: bool = False):
+def clean_epub(epub_path: Path, keep_first: bool = False, cryptographic_hash: bool = False, compress_level: int = 1):
     if not epub_path.is_file():
         print(f"Error: File not found at {epub_path}"); return
     # Ensure the file is a ZIP archive before proceeding.
@@ -131,103 +270,152 @@ def clean_epub(epub_path: Path, keep_first: bool = False):
     if keep_first:
         print("Mode: --keep-first flag detected. Keeping the first instance of each article.")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_path = Path(temp_dir)
-        try:
-            with zipfile.ZipFile(epub_path, 'r') as zip_ref: zip_ref.extractall(temp_path)
-        except zipfile.BadZipFile:
-            print(f"Error: Failed to unzip '{epub_path.name}'. File corrupted or not a valid ePub. Aborting.")
-            return
+    unzip_error = f"Error: Failed to unzip '{epub_path.name}'. File corrupted or not a valid ePub. Aborting."
+    try:
+        zip_ref = zipfile.ZipFile(epub_path, 'r')
+    except zipfile.BadZipFile:
+        print(unzip_error)
+        return
 
-        # Step 1: Detect type and set the correct article marker
-        epub_type = detect_epub_type(temp_path)
-        if epub_type == 'unsupported':
-            print(f"Error: '{epub_path.name}' does not appear to be a PressReader-generated ePub. Aborting.")
+    # Everything below works on the archive's entries in memory, nothing is extracted to disk
+    with zip_ref:
+        # Reading entries checks their CRCs, so a corrupt file fails here like extracting it would
+        try:
+            # Step 1: Detect type and set the correct article marker
+            epub_type = detect_epub_type(zip_ref)
+            if epub_type == 'unsupported':
+                print(f"Error: '{epub_path.name}' does not appear to be a PressReader-generated ePub. Aborting.")
+                return
+
+            # Page files are any .xhtml under a page-* folder of OEBPS (or the root), found with plain string checks
+            names = zip_ref.namelist()
+            oebps_prefix = find_oebps_prefix(names)
+            page_prefix = oebps_prefix + 'page-'
+            all_xhtml_files = [
+                name for name in names
+                if name.startswith(page_prefix) and name.endswith('.xhtml') and '/' in name[len(page_prefix):]
+            ]
+            # Sort by page number so every list in hashes_to_paths comes out in page order
+            all_xhtml_files.sort(key=lambda p: (get_page_num_from_path(p) or 0, p))
+            xhtml_contents = {name: zip_ref.read(name) for name in all_xhtml_files}
+
+            # Deleted pages are recorded relative to the OPF/NCX folder, as the manifest refers to them.
+            # Raw files keep opf and ncx inside OEBPS, Calibre files keep them in the root.
+            metadata_base_path = oebps_prefix if epub_type == 'raw' else ''
+            metadata_contents = {name: zip_ref.read(name) for name in find_metadata_files(names, metadata_base_path)}
+        except (zipfile.BadZipFile, zlib.error):
+            print(unzip_error)
             return
-        elif epub_type == 'calibre':
-            article_selector_args = ('div', {'class': 'toc'})
-        else: # raw
-            article_selector_args = ('div', {'class': 'art-cnt'})
-
-        oebps_path = next(temp_path.glob("**/OEBPS"), temp_path)
-        all_xhtml_files = sorted(oebps_path.glob("page-*/**/*.xhtml"))
 
         # Stage 1: Gather information
         print("Stage 1: Analyzing article locations...")
         hashes_to_paths = defaultdict(list)
-        for xhtml_file in all_xhtml_files:
-            with open(xhtml_file, 'r', encoding='utf-8') as f:
-                soup = BeautifulSoup(f, 'xml')
-            for article in soup.find_all(*article_selector_args):
-                article_hash = get_article_hash(article)
+        # Parsing and hashing is independent per file, so fan it out across cores.
+        # Workers send back a (length, hash) pair per article rather than its text.
+        with ProcessPoolExecutor() as executor:
+            scan = partial(_scan_file, epub_type=epub_type, cryptographic_hash=cryptographic_hash)
+            scan_results = dict(zip(all_xhtml_files, executor.map(scan, xhtml_contents.values(), chunksize=8)))
+        files_with_body = {xhtml_file for xhtml_file, (_, has_body) in scan_results.items() if has_body}
+
+        # Texts of different lengths can't be duplicates, so articles with a unique length are keyed by it alone
+        # and only those sharing a length are told apart by hash. The per-file key lists are kept for Stage 3.
+        text_length_counts = Counter(length for fingerprints, _ in scan_results.values() for length, _ in fingerprints)
+        article_hashes_by_file = {}
+        for xhtml_file, (fingerprints, _) in scan_results.items():
+            article_hashes = []
+            for length, digest in fingerprints:
+                article_hash = f"len:{length}" if text_length_counts[length] == 1 else digest
+                article_hashes.append(article_hash)
                 hashes_to_paths[article_hash].append(xhtml_file)
+            article_hashes_by_file[xhtml_file] = article_hashes
 
         # Stage 2: Decide which single version of each article to keep
         print("Stage 2: Deciding which articles to keep...")
+        # Kept articles are stored as (hash, file id) so Stage 3's lookups hash a small int, not a path
+        file_ids = {xhtml_file: i for i, xhtml_file in enumerate(all_xhtml_files)}
         articles_to_keep = set()
         for article_hash, path_list in hashes_to_paths.items():
             if len(path_list) == 1:
-                articles_to_keep.add((article_hash, path_list[0]))
+                articles_to_keep.add((article_hash, file_ids[path_list[0]]))
             else:
                 if keep_first:
-                    # Sort paths by page number and keep the very first one
-                    sorted_paths = sorted(path_list, key=lambda p: get_page_num_from_path(p) or 0)
-                    correct_path = sorted_paths[0]
+                    # Paths are already in page order, keep the very first one
+                    correct_path = path_list[0]
                 else:
                     # Use the default "first of the last consecutive block" rule
                     correct_path = find_correct_version(path_list)
 
                 if correct_path:
-                    articles_to_keep.add((article_hash, correct_path))
+                    articles_to_keep.add((article_hash, file_ids[correct_path]))
 
         # Stage 3: Clean the files
         print("Stage 3: Cleaning files...")
         files_to_delete = set()
+        deleted_rel_paths = set()
+        modified_files = {}
         articles_removed_count = 0
 
-        for xhtml_file in all_xhtml_files:
-            with open(xhtml_file, 'r', encoding='utf-8') as f:
-                soup = BeautifulSoup(f, 'xml')
-
-            articles_in_file = soup.find_all(*article_selector_args)
-            if not articles_in_file or not soup.body: continue
-
-            articles_kept_in_file = 0
-            for article in articles_in_file:
-                article_hash = get_article_hash(article)
-                if (article_hash, xhtml_file) in articles_to_keep:
-                    articles_kept_in_file += 1
-                else:
-                    article.decompose()
-                    articles_removed_count += 1
-
-            if articles_kept_in_file == 0 and len(articles_in_file) > 0:
+        files_to_clean = []
+        keep_flags_by_file = []
+        for xhtml_file, article_hashes in article_hashes_by_file.items():
+            if xhtml_file not in files_with_body: continue
+            file_id = file_ids[xhtml_file]
+            keep_flags = [(article_hash, file_id) in articles_to_keep for article_hash in article_hashes]
+            # Files keeping every article (or with none) stay as they are, no need to rewrite them
+            if all(keep_flags): continue
+
+            articles_removed_count += keep_flags.count(False)
+            if not any(keep_flags):
+                # Nothing left in it, so it is deleted without being rewritten
                 files_to_delete.add(xhtml_file)
+                deleted_rel_paths.add(xhtml_file[len(metadata_base_path):])
+            else:
+                files_to_clean.append(xhtml_file)
+                keep_flags_by_file.append(keep_flags)
 
-            with open(xhtml_file, 'w', encoding='utf-8') as f:
-                f.write(str(soup))
+        # Only files that keep some articles and lose others are parsed and rewritten.
+        # Often there are none, so don't start a worker pool for nothing.
+        if files_to_clean:
+            with ProcessPoolExecutor() as executor:
+                clean = partial(_clean_file, epub_type=epub_type)
+                results = executor.map(clean, [xhtml_contents[f] for f in files_to_clean], keep_flags_by_file, chunksize=8)
+                modified_files.update(zip(files_to_clean, results))
 
         # Stage 4: Delete empty files and update metadata
         if files_to_delete:
             print(f"Stage 4: Removing {len(files_to_delete)} empty files and updating manifest...")
-            update_metadata_files(temp_path, files_to_delete, epub_type)
-            for f in files_to_delete:
-                if f.is_file(): f.unlink()
+            modified_files.update(update_metadata_files(metadata_contents, deleted_rel_paths))
 
         # Stage 5: Re-pack the ePub
+        # Only modified files are deflated again, everything else is copied over still compressed
         print("Stage 5: Re-packing the clean ePub...")
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            mimetype_path = temp_path / 'mimetype'
-            if mimetype_path.exists():
-                zipf.write(mimetype_path, 'mimetype', compress_type=zipfile.ZIP_STORED)
-
-            for root, dirs, files in os.walk(temp_dir):
-                for file in files:
-                    if file == 'mimetype': continue
-                    file_path = Path(root) / file
-                    if file_path.is_file():
-                      archive_name = file_path.relative_to(temp_path)
-                      zipf.write(file_path, archive_name)
+        # Copied entries aren't inflated, but a broken local header still shows up here
+        try:
+            with zipfile.ZipFile(output_path, 'w') as zipf:
+                source_infos = [info for info in zip_ref.infolist() if not info.is_dir() and info.filename not in files_to_delete]
+                if 'mimetype' in zip_ref.NameToInfo:
+                    zipf.writestr('mimetype', zip_ref.read('mimetype'), compress_type=zipfile.ZIP_STORED)
+
+                # Deflate modified files on worker threads, then append every entry in order on this one
+                with ThreadPoolExecutor() as executor:
+                    compressed = {
+                        info.filename: executor.submit(compress_entry, info, modified_files[info.filename], compress_level)
+                        for info in source_infos if info.filename in modified_files
+                    }
+                    for info in source_infos:
+                        if info.filename == 'mimetype': continue
+                        if info.filename in compressed:
+                            zinfo, payload = compressed[info.filename].result()
+                        elif info.flag_bits & 0x1:
+                            # Encrypted entries can't be copied raw, go through zipfile (which checks the password)
+                            zinfo, payload = compress_entry(info, zip_ref.read(info), compress_level)
+                        else:
+                            zinfo, payload = copy_entry(zip_ref, info)
+                        write_compressed_entry(zipf, zinfo, payload)
+        except (zipfile.BadZipFile, zlib.error):
+            output_path.unlink(missing_ok=True)
+            print(unzip_error)
+            return
 
     print("\n--------------------")
     print("Cleaning Metrics:")
@@ -240,5 +428,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Clean PressReader ePub files by removing duplicate articles.")
     parser.add_argument("epub_file", type=str, help="The path to the .epub file to be cleaned.")
     parser.add_argument("--keep-first", action="store_true", help="Keep the very first instance of an article, useful for files without a 'Content' section.")
+    parser.add_argument("--cryptographic-hash", action="store_true", help="Fingerprint articles with SHA256 instead of the faster xxh3_128.")
+    parser.add_argument("--compress-level", type=int, default=1, choices=range(0, 10), metavar="0-9", help="Deflate level for the rewritten pages and OPF/NCX (default: 1, fastest). Untouched entries keep their original compression.")
     args = parser.parse_args()
-    clean_epub(Path(args.epub_file), keep_first=args.keep_first)
+    clean_epub(Path(args.epub_file), keep_first=args.keep_first, cryptographic_hash=args.cryptographic_hash, compress_level=args.compress_level)